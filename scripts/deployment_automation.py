@@ -10,11 +10,16 @@ import json
 import subprocess
 import argparse
 import shutil
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 import logging
 
+from resource_governor import ResourceGovernor
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -44,6 +49,18 @@ class DeploymentAutomation:
         self.dist_dir.mkdir(exist_ok=True)
         (self.project_root / 'scripts').mkdir(exist_ok=True)
 
+        # 同一平台的构建共享Flutter中间产物目录，矩阵构建时按平台串行
+        self.platform_locks = {
+            platform: threading.Lock()
+            for platform in ['android', 'ios', 'web', 'desktop']
+        }
+
+        # 构建子进程资源调度
+        resources = self.config.get("resources", {})
+        self.governor = None
+        if resources.get("enabled", True):
+            self.governor = ResourceGovernor(resources, self.project_root / 'scripts' / 'resource_profile.json')
+
     def load_config(self) -> Dict[str, Any]:
         """加载部署配置"""
         if not self.config_file.exists():
@@ -89,6 +106,29 @@ class DeploymentAutomation:
                 },
                 "deploy": {
                     "environments": ["development", "staging", "production"],
+                    "environment_settings": {
+                        "development": {
+                            "dart_defines": {"APP_ENV": "development"},
+                            "dart_define_from_file": None,
+                            "version_suffix": "-dev",
+                            "priority": 0
+                        },
+                        "staging": {
+                            "dart_defines": {"APP_ENV": "staging"},
+                            "dart_define_from_file": None,
+                            "version_suffix": "-staging",
+                            "priority": 1
+                        },
+                        "production": {
+                            "dart_defines": {"APP_ENV": "production"},
+                            "dart_define_from_file": None,
+                            "version_suffix": "",
+                            "priority": 2
+                        }
+                    },
+                    "matrix": {
+                        "max_parallel": 3
+                    },
                     "auto_increment": {
                         "build": True,
                         "patch": False,
@@ -107,6 +147,16 @@ class DeploymentAutomation:
                         "play_store": False
                     }
                 },
+                "resources": {
+                    "enabled": True,
+                    "reserve_mb": 1024,
+                    "critical_available_mb": 512,
+                    "critical_action": "requeue",
+                    "max_load_per_cpu": 1.5,
+                    "max_jobs": 0,
+                    "max_requeues": 3,
+                    "poll_interval": 2.0
+                },
                 "notification": {
                     "slack": False,
                     "email": False,
@@ -184,17 +234,24 @@ class DeploymentAutomation:
         self.version_info["version"] = f"{major}.{minor}.{patch}"
         self.save_version_info()
 
-    def run_command(self, command: List[str], cwd: Optional[Path] = None) -> subprocess.CompletedProcess:
-        """运行命令"""
+    def run_command(self, command: List[str], cwd: Optional[Path] = None,
+                    job_type: Optional[str] = None, priority: int = 0,
+                    extra_env: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+        """运行命令，指定job_type的重负载命令由资源调度器决定何时启动"""
+        env = {**os.environ, **extra_env} if extra_env else None
         try:
             logger.info(f"执行命令: {' '.join(command)}")
-            result = subprocess.run(
-                command,
-                cwd=cwd or self.project_root,
-                capture_output=True,
-                text=True,
-                check=True
-            )
+            if job_type and self.governor:
+                result = self.governor.run(command, cwd or self.project_root, job_type, priority, env)
+            else:
+                result = subprocess.run(
+                    command,
+                    cwd=cwd or self.project_root,
+                    env=env,
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
             logger.info(f"命令执行成功: {result.stdout}")
             return result
         except subprocess.CalledProcessError as e:
@@ -247,11 +304,11 @@ class DeploymentAutomation:
         try:
             # 单元测试
             if self.config["test"]["unit_tests"]:
-                self.run_command(['flutter', 'test'])
+                self.run_command(['flutter', 'test'], job_type='test')
 
             # 测试覆盖率
             if self.config["test"]["coverage"]:
-                self.run_command(['flutter', 'test', '--coverage'])
+                self.run_command(['flutter', 'test', '--coverage'], job_type='test')
                 # 生成覆盖率报告
                 coverage_dir = self.build_dir / 'coverage'
                 coverage_dir.mkdir(exist_ok=True)
@@ -263,13 +320,153 @@ class DeploymentAutomation:
             logger.error(f"测试失败: {e}")
             return False
 
-    def build_android(self) -> bool:
+    def env_label(self, env: Optional[Dict[str, Any]]) -> str:
+        """日志中使用的环境标签"""
+        return f" [{env['name']}]" if env else ""
+
+    def get_environments(self, selected: Optional[List[str]] = None) -> List[str]:
+        """获取要构建的环境列表"""
+        environments = self.config["deploy"].get("environments", [])
+        if not selected:
+            return list(environments)
+
+        unknown = [name for name in selected if name not in environments]
+        if unknown:
+            raise ValueError(f"未在配置中声明的环境: {', '.join(unknown)}")
+        return [name for name in environments if name in selected]
+
+    def resolve_environment(self, name: str) -> Dict[str, Any]:
+        """解析单个环境的构建参数、输出目录和版本信息"""
+        settings = self.config["deploy"].get("environment_settings", {}).get(name, {})
+
+        dart_defines = dict(settings.get("dart_defines", {}))
+        dart_defines.setdefault("APP_ENV", name)
+
+        version = self.version_info["version"]
+        build = self.version_info["build"]
+        display_version = f"{version}{settings.get('version_suffix', '')}"
+        dart_defines.setdefault("APP_VERSION", f"{display_version}+{build}")
+
+        build_args = ['--build-name', version, '--build-number', str(build)]
+        for key, value in dart_defines.items():
+            build_args.append(f'--dart-define={key}={value}')
+
+        define_files = settings.get("dart_define_from_file") or []
+        if isinstance(define_files, str):
+            define_files = [define_files]
+        for define_file in define_files:
+            define_path = self.project_root / define_file
+            if not define_path.exists():
+                raise FileNotFoundError(f"环境 {name} 的dart-define文件不存在: {define_path}")
+            build_args.append(f'--dart-define-from-file={define_path}')
+
+        return {
+            "name": name,
+            "dist_dir": self.dist_dir / name,
+            "build_args": build_args,
+            "priority": settings.get("priority", 0),
+            "version_info": {
+                **self.version_info,
+                "environment": name,
+                "display_version": display_version,
+                "dart_defines": dart_defines
+            }
+        }
+
+    def write_version_stamp(self, env: Optional[Dict[str, Any]] = None) -> Path:
+        """写入版本信息文件，矩阵构建时每个环境单独写入"""
+        dist_dir = env["dist_dir"] if env else self.dist_dir
+        dist_dir.mkdir(parents=True, exist_ok=True)
+        version_info_path = dist_dir / "version_info.json"
+        with open(version_info_path, 'w', encoding='utf-8') as f:
+            json.dump(env["version_info"] if env else self.version_info, f, indent=2, ensure_ascii=False)
+        return version_info_path
+
+    def build_platform(self, platform: str, env: Optional[Dict[str, Any]] = None) -> bool:
+        """构建指定平台，同一平台的构建互斥执行"""
+        builders = {
+            'android': self.build_android,
+            'ios': self.build_ios,
+            'web': self.build_web,
+            'desktop': self.build_desktop
+        }
+        with self.platform_locks[platform]:
+            return builders[platform](env)
+
+    def build_matrix(self, environments: Optional[List[str]] = None,
+                     platforms: Optional[List[str]] = None) -> bool:
+        """
+        按环境矩阵构建
+        依赖获取和测试由调用方统一执行一次，这里只调度各环境的构建任务
+        """
+        names = self.get_environments(environments)
+        if not names:
+            logger.warning("未配置任何环境，跳过矩阵构建")
+            return True
+
+        platforms = platforms or ['android', 'ios', 'web', 'desktop']
+        envs = [self.resolve_environment(name) for name in names]
+        for env in envs:
+            self.write_version_stamp(env)
+
+        max_parallel = self.config["deploy"].get("matrix", {}).get("max_parallel", len(envs))
+        max_workers = max(1, min(max_parallel, len(envs) * len(platforms)))
+        logger.info(f"开始矩阵构建: 环境 {', '.join(names)}，平台 {', '.join(platforms)}，并发 {max_workers}")
+
+        # 按平台轮转提交，让不同环境的不同平台可以同时构建
+        jobs = []
+        for index in range(len(platforms)):
+            for offset, env in enumerate(envs):
+                jobs.append((env, platforms[(index + offset) % len(platforms)]))
+
+        results: Dict[str, bool] = {name: True for name in names}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (env, platform, executor.submit(self.build_platform, platform, env))
+                for env, platform in jobs
+            ]
+            try:
+                for env, platform, future in futures:
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        logger.error(f"{platform}构建异常{self.env_label(env)}: {e}")
+                        ok = False
+                    results[env["name"]] &= ok
+            except KeyboardInterrupt:
+                logger.warning("矩阵构建被中断，取消剩余任务")
+                for _, _, future in futures:
+                    future.cancel()
+                if self.governor:
+                    self.governor.cancel()
+                raise
+
+        for env in envs:
+            if results[env["name"]]:
+                self.create_release_archive(env)
+            else:
+                logger.error(f"环境 {env['name']} 构建失败，跳过归档")
+
+        return all(results.values())
+
+    def build_android(self, env: Optional[Dict[str, Any]] = None) -> bool:
         """构建Android应用"""
         if not self.config["build"]["android"]["enabled"]:
             logger.info("Android构建已禁用，跳过")
             return True
 
-        logger.info("构建Android应用...")
+        dist_dir = env["dist_dir"] if env else self.dist_dir
+        build_args = env["build_args"] if env else []
+        priority = env["priority"] if env else 0
+
+        # Gradle守护进程会脱离构建进程树并在多次构建间复用，受调度时禁用它，
+        # 让Gradle的内存计入本次任务
+        gradle_env = None
+        if self.governor:
+            gradle_opts = os.environ.get('GRADLE_OPTS', '')
+            gradle_env = {"GRADLE_OPTS": f"{gradle_opts} -Dorg.gradle.daemon=false".strip()}
+
+        logger.info(f"构建Android应用{self.env_label(env)}...")
         try:
             build_types = self.config["build"]["android"]["build_types"]
 
@@ -278,38 +475,51 @@ class DeploymentAutomation:
                     # Debug APK
                     if self.config["build"]["android"]["apk"]:
                         self.run_command([
-                            'flutter', 'build', 'apk', '--debug',
-                            '--output', str(self.dist_dir / 'android' / 'debug')
-                        ])
+                            'flutter', 'build', 'apk', '--debug', *build_args
+                        ], job_type='android-apk-debug', priority=priority, extra_env=gradle_env)
+                        self.collect_build_output(
+                            self.build_dir / 'app' / 'outputs' / 'flutter-apk' / 'app-debug.apk',
+                            dist_dir / 'android' / 'debug'
+                        )
 
                 elif build_type == "release":
                     # Release APK
                     if self.config["build"]["android"]["apk"]:
                         self.run_command([
-                            'flutter', 'build', 'apk', '--release',
-                            '--output', str(self.dist_dir / 'android' / 'release')
-                        ])
+                            'flutter', 'build', 'apk', '--release', *build_args
+                        ], job_type='android-apk-release', priority=priority, extra_env=gradle_env)
+                        self.collect_build_output(
+                            self.build_dir / 'app' / 'outputs' / 'flutter-apk' / 'app-release.apk',
+                            dist_dir / 'android' / 'release'
+                        )
 
                     # Release AAB
                     if self.config["build"]["android"]["aab"]:
                         self.run_command([
-                            'flutter', 'build', 'appbundle', '--release',
-                            '--output', str(self.dist_dir / 'android' / 'release')
-                        ])
-
-            logger.info("Android构建完成")
+                            'flutter', 'build', 'appbundle', '--release', *build_args
+                        ], job_type='android-aab', priority=priority, extra_env=gradle_env)
+                        self.collect_build_output(
+                            self.build_dir / 'app' / 'outputs' / 'bundle' / 'release' / 'app-release.aab',
+                            dist_dir / 'android' / 'release'
+                        )
+
+            logger.info(f"Android构建完成{self.env_label(env)}")
             return True
         except Exception as e:
-            logger.error(f"Android构建失败: {e}")
+            logger.error(f"Android构建失败{self.env_label(env)}: {e}")
             return False
 
-    def build_ios(self) -> bool:
+    def build_ios(self, env: Optional[Dict[str, Any]] = None) -> bool:
         """构建iOS应用"""
         if not self.config["build"]["ios"]["enabled"]:
             logger.info("iOS构建已禁用，跳过")
             return True
 
-        logger.info("构建iOS应用...")
+        dist_dir = env["dist_dir"] if env else self.dist_dir
+        build_args = env["build_args"] if env else []
+        priority = env["priority"] if env else 0
+
+        logger.info(f"构建iOS应用{self.env_label(env)}...")
         try:
             build_types = self.config["build"]["ios"]["build_types"]
 
@@ -318,12 +528,17 @@ class DeploymentAutomation:
                     # Debug构建
                     self.run_command([
                         'flutter', 'build', 'ios', '--debug',
-                        '--simulator'
-                    ])
+                        '--simulator', *build_args
+                    ], job_type='ios-debug', priority=priority)
+                    self.collect_build_output(self.build_dir / 'ios' / 'iphonesimulator' / 'Runner.app',
+                                              dist_dir / 'ios' / 'debug')
 
                 elif build_type == "release":
                     # Release构建
-                    self.run_command(['flutter', 'build', 'ios', '--release'])
+                    self.run_command(['flutter', 'build', 'ios', '--release', *build_args],
+                                     job_type='ios-release', priority=priority)
+                    self.collect_build_output(self.build_dir / 'ios' / 'iphoneos' / 'Runner.app',
+                                              dist_dir / 'ios' / 'release')
 
                     # Archive
                     if self.config["build"]["ios"]["archive"]:
@@ -331,22 +546,58 @@ class DeploymentAutomation:
                             'xcodebuild', '-workspace', 'ios/Runner.xcworkspace',
                             '-scheme', 'Runner', '-configuration', 'Release',
                             '-destination', 'generic/platform=iOS',
-                            'archive', '-archivePath', str(self.build_dir / 'ios' / 'Runner.xcarchive')
-                        ], cwd=self.project_root)
+                            'archive', '-archivePath', str(dist_dir / 'ios' / 'Runner.xcarchive')
+                        ], cwd=self.project_root, job_type='xcodebuild', priority=priority)
 
-            logger.info("iOS构建完成")
+            logger.info(f"iOS构建完成{self.env_label(env)}")
             return True
         except Exception as e:
-            logger.error(f"iOS构建失败: {e}")
+            logger.error(f"iOS构建失败{self.env_label(env)}: {e}")
             return False
 
-    def build_web(self) -> bool:
+    def collect_build_output(self, source: Path, output_dir: Path):
+        """
+        复制flutter build的产物到输出目录
+        除web外flutter不支持指定输出目录，产物固定写入build/，需在平台锁内复制
+        """
+        if not source.exists():
+            raise FileNotFoundError(f"未找到构建产物: {source}")
+        target = output_dir / source.name
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if source.is_dir():
+            if target.exists():
+                shutil.rmtree(target)
+            shutil.copytree(source, target, symlinks=True)
+        else:
+            shutil.copy2(source, target)
+
+    def desktop_build_output(self, platform: str, arch: str) -> Path:
+        """桌面平台在build/下的产物目录"""
+        if platform == 'windows':
+            candidates = [
+                self.build_dir / 'windows' / arch / 'runner' / 'Release',
+                self.build_dir / 'windows' / 'runner' / 'Release'
+            ]
+        elif platform == 'linux':
+            candidates = [self.build_dir / 'linux' / arch / 'release' / 'bundle']
+        else:
+            candidates = [self.build_dir / 'macos' / 'Build' / 'Products' / 'Release']
+        for candidate in candidates:
+            if candidate.exists():
+                return candidate
+        return candidates[0]
+
+    def build_web(self, env: Optional[Dict[str, Any]] = None) -> bool:
         """构建Web应用"""
         if not self.config["build"]["web"]["enabled"]:
             logger.info("Web构建已禁用，跳过")
             return True
 
-        logger.info("构建Web应用...")
+        dist_dir = env["dist_dir"] if env else self.dist_dir
+        build_args = env["build_args"] if env else []
+        priority = env["priority"] if env else 0
+
+        logger.info(f"构建Web应用{self.env_label(env)}...")
         try:
             base_href = self.config["build"]["web"]["base_href"]
             pwa = self.config["build"]["web"]["pwa"]
@@ -357,31 +608,36 @@ class DeploymentAutomation:
 
             self.run_command([
                 *command,
-                '--output', str(self.dist_dir / 'web')
-            ])
+                *build_args,
+                '--output', str(dist_dir / 'web')
+            ], job_type='web', priority=priority)
 
-            logger.info("Web构建完成")
+            logger.info(f"Web构建完成{self.env_label(env)}")
             return True
         except Exception as e:
-            logger.error(f"Web构建失败: {e}")
+            logger.error(f"Web构建失败{self.env_label(env)}: {e}")
             return False
 
-    def build_desktop(self) -> bool:
+    def build_desktop(self, env: Optional[Dict[str, Any]] = None) -> bool:
         """构建桌面应用"""
         platforms = ['windows', 'linux', 'macos']
         success = True
 
+        dist_dir = env["dist_dir"] if env else self.dist_dir
+        build_args = env["build_args"] if env else []
+        priority = env["priority"] if env else 0
+
         for platform in platforms:
             if not self.config["build"][platform]["enabled"]:
                 logger.info(f"{platform.title()}构建已禁用，跳过")
                 continue
 
-            logger.info(f"构建{platform.title()}应用...")
+            logger.info(f"构建{platform.title()}应用{self.env_label(env)}...")
             try:
                 architectures = self.config["build"][platform]["architecture"]
 
                 for arch in architectures:
-                    output_dir = self.dist_dir / platform / arch
+                    output_dir = dist_dir / platform / arch
                     command = ['flutter', 'build', platform]
 
                     if platform == 'windows':
@@ -391,49 +647,50 @@ class DeploymentAutomation:
                     elif platform == 'macos':
                         command.extend(['--release', f'--{arch}'])
 
-                    command.extend(['--output', str(output_dir)])
-                    self.run_command(command)
+                    command.extend(build_args)
+                    self.run_command(command, job_type=platform, priority=priority)
+                    self.collect_build_output(self.desktop_build_output(platform, arch), output_dir)
 
-                logger.info(f"{platform.title()}构建完成")
+                logger.info(f"{platform.title()}构建完成{self.env_label(env)}")
             except Exception as e:
-                logger.error(f"{platform.title()}构建失败: {e}")
+                logger.error(f"{platform.title()}构建失败{self.env_label(env)}: {e}")
                 success = False
 
         return success
 
-    def create_release_archive(self) -> bool:
+    def create_release_archive(self, env: Optional[Dict[str, Any]] = None) -> bool:
         """创建发布归档"""
-        logger.info("创建发布归档...")
+        logger.info(f"创建发布归档{self.env_label(env)}...")
         try:
+            dist_dir = env["dist_dir"] if env else self.dist_dir
             version = self.version_info["version"]
             build = self.version_info["build"]
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            archive_name = f"chaoxingrc_v{version}_build{build}_{timestamp}"
-            archive_path = self.dist_dir / f"{archive_name}.tar.gz"
+            env_part = f"_{env['name']}" if env else ""
+            archive_name = f"chaoxingrc_v{version}_build{build}{env_part}_{timestamp}"
+            archive_path = dist_dir / f"{archive_name}.tar.gz"
 
             # 创建版本信息文件
-            version_info_path = self.dist_dir / "version_info.json"
-            with open(version_info_path, 'w', encoding='utf-8') as f:
-                json.dump(self.version_info, f, indent=2, ensure_ascii=False)
+            self.write_version_stamp(env)
 
             # 创建归档
             import tarfile
             with tarfile.open(archive_path, 'w:gz') as tar:
-                tar.add(self.dist_dir / 'version_info.json', arcname='version_info.json')
+                tar.add(dist_dir / 'version_info.json', arcname='version_info.json')
 
                 # 添加构建产物
-                if (self.dist_dir / 'android').exists():
-                    tar.add(self.dist_dir / 'android', arcname=f'{archive_name}/android')
-                if (self.dist_dir / 'ios').exists():
-                    tar.add(self.dist_dir / 'ios', arcname=f'{archive_name}/ios')
-                if (self.dist_dir / 'web').exists():
-                    tar.add(self.dist_dir / 'web', arcname=f'{archive_name}/web')
-                if (self.dist_dir / 'windows').exists():
-                    tar.add(self.dist_dir / 'windows', arcname=f'{archive_name}/windows')
-                if (self.dist_dir / 'linux').exists():
-                    tar.add(self.dist_dir / 'linux', arcname=f'{archive_name}/linux')
-                if (self.dist_dir / 'macos').exists():
-                    tar.add(self.dist_dir / 'macos', arcname=f'{archive_name}/macos')
+                if (dist_dir / 'android').exists():
+                    tar.add(dist_dir / 'android', arcname=f'{archive_name}/android')
+                if (dist_dir / 'ios').exists():
+                    tar.add(dist_dir / 'ios', arcname=f'{archive_name}/ios')
+                if (dist_dir / 'web').exists():
+                    tar.add(dist_dir / 'web', arcname=f'{archive_name}/web')
+                if (dist_dir / 'windows').exists():
+                    tar.add(dist_dir / 'windows', arcname=f'{archive_name}/windows')
+                if (dist_dir / 'linux').exists():
+                    tar.add(dist_dir / 'linux', arcname=f'{archive_name}/linux')
+                if (dist_dir / 'macos').exists():
+                    tar.add(dist_dir / 'macos', arcname=f'{archive_name}/macos')
 
             logger.info(f"发布归档创建完成: {archive_path}")
             return True
@@ -528,9 +785,29 @@ class DeploymentAutomation:
         parser.add_argument('--clean', action='store_true', help='清理项目')
         parser.add_argument('--test-only', action='store_true', help='仅运行测试')
         parser.add_argument('--deploy', action='store_true', help='执行完整部署')
+        parser.add_argument('--matrix', action='store_true',
+                          help='按deploy.environments矩阵构建，共享一次依赖获取和测试')
+        parser.add_argument('--env', nargs='+', help='矩阵构建时指定环境（默认全部）')
 
         parsed_args = parser.parse_args(args)
 
+        # CI取消任务时发送SIGTERM，按用户中断处理以便终止构建子进程
+        def handle_sigterm(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        if parsed_args.env and not parsed_args.matrix:
+            parser.error('--env 只能与 --matrix 一起使用')
+        if parsed_args.matrix and parsed_args.deploy:
+            # deploy()会清理dist/并重新执行非矩阵构建，覆盖矩阵产物
+            parser.error('--matrix 不能与 --deploy 一起使用')
+        if parsed_args.matrix:
+            # 在更新版本号和执行测试前校验环境名称
+            try:
+                self.get_environments(parsed_args.env)
+            except ValueError as e:
+                parser.error(str(e))
+
         try:
             if parsed_args.clean:
                 self.clean_project()
@@ -558,7 +835,17 @@ class DeploymentAutomation:
 
             # 构建
             if not parsed_args.skip_build:
-                if parsed_args.platform:
+                if parsed_args.matrix:
+                    platforms = None
+                    if parsed_args.platform:
+                        platforms = ['desktop' if parsed_args.platform in ['windows', 'linux', 'macos']
+                                     else parsed_args.platform]
+                    if not self.build_matrix(parsed_args.env, platforms):
+                        logger.error("矩阵构建失败")
+                        sys.exit(1)
+                    # 矩阵构建只生成各环境的归档，不发布GitHub Release
+                    logger.info("矩阵构建不发布GitHub Release，请使用对应环境的归档手动发布")
+                elif parsed_args.platform:
                     # 构建指定平台
                     if parsed_args.platform == 'android':
                         self.build_android()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+构建子进程资源调度器
+根据系统内存、负载和子进程树RSS决定何时启动新的构建任务，
+内存紧张时暂停或重新排队优先级最低的任务
+"""
+
+import os
+import sys
+import json
+import signal
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Tuple
+import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# 估算下限取最近几次峰值中的最大值，避免一次增量构建把估算拉得过低
+RECENT_PEAKS = 5
+
+# 各类任务的初始内存估算（MB），按任务类型前缀匹配（如android-apk-release使用android），
+# 运行后与实际峰值RSS平滑合并
+DEFAULT_COSTS_MB = {
+    "android": 4096,
+    "ios": 4096,
+    "xcodebuild": 6144,
+    "web": 3072,
+    "windows": 3072,
+    "linux": 3072,
+    "macos": 3072,
+    "test": 2048,
+    "default": 1024
+}
+
+
+def read_memory() -> Optional[Tuple[int, int]]:
+    """读取系统内存 (总量MB, 可用MB)，无法获取时返回None"""
+    if psutil:
+        vm = psutil.virtual_memory()
+        return vm.total // MB, vm.available // MB
+
+    try:
+        info = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0])
+        available = info.get('MemAvailable', info.get('MemFree', 0))
+        return info['MemTotal'] // 1024, available // 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def read_load() -> Optional[float]:
+    """读取每个CPU的1分钟平均负载，无法获取时返回None"""
+    try:
+        load = psutil.getloadavg()[0] if psutil else os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+    return load / (os.cpu_count() or 1)
+
+
+def list_process_tree(pid: int) -> List[int]:
+    """获取进程及其所有子进程的PID"""
+    if psutil:
+        try:
+            root = psutil.Process(pid)
+            return [pid] + [child.pid for child in root.children(recursive=True)]
+        except psutil.Error:
+            return []
+
+    children: Dict[int, List[int]] = {}
+    for entry in Path('/proc').iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # comm字段可能包含空格，从最后一个')'之后解析
+            stat = (entry / 'stat').read_text()
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def process_tree_rss(pid: int) -> int:
+    """统计进程树的RSS总和（MB）"""
+    total = 0
+    for tree_pid in list_process_tree(pid):
+        if psutil:
+            try:
+                total += psutil.Process(tree_pid).memory_info().rss
+            except psutil.Error:
+                continue
+        else:
+            try:
+                with open(f'/proc/{tree_pid}/status', 'r') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+                            break
+            except (OSError, ValueError):
+                continue
+    return total // MB
+
+
+class BuildJob:
+    """一个受调度的构建子进程"""
+
+    def __init__(self, command: List[str], job_type: str, priority: int, seq: int):
+        self.command = command
+        self.job_type = job_type
+        self.priority = priority
+        self.seq = seq
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.rss_mb = 0
+        self.peak_rss_mb = 0
+        self.samples = 0
+        self.paused = False
+        self.requeued = False
+        self.requeue_count = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.job_type}#{self.seq}"
+
+
+class ResourceGovernor:
+    def __init__(self, config: Dict[str, Any], profile_file: Path):
+        """初始化资源调度器"""
+        self.reserve_mb = config.get("reserve_mb", 1024)
+        self.critical_available_mb = config.get("critical_available_mb", 512)
+        self.critical_action = config.get("critical_action", "requeue")
+        self.max_load_per_cpu = config.get("max_load_per_cpu", 1.5)
+        self.max_jobs = config.get("max_jobs", 0)
+        self.max_requeues = config.get("max_requeues", 3)
+        self.poll_interval = config.get("poll_interval", 2.0)
+        self.safety_factor = config.get("safety_factor", 1.2)
+        self.default_costs = {**DEFAULT_COSTS_MB, **config.get("default_costs_mb", {})}
+
+        # 无法暂停进程的平台只能重新排队
+        if self.critical_action == "pause" and not (psutil or hasattr(signal, 'SIGSTOP')):
+            logger.warning("当前平台不支持暂停进程，内存紧张时改为重新排队")
+            self.critical_action = "requeue"
+
+        self.profile_file = profile_file
+        self.profile = self.load_profile()
+
+        self.lock = threading.Condition()
+        self.waiting: List[BuildJob] = []
+        self.running: List[BuildJob] = []
+        self.seq = 0
+        self.cancelled = False
+        self.monitor_thread: Optional[threading.Thread] = None
+
+    def load_profile(self) -> Dict[str, Any]:
+        """加载历史峰值内存记录"""
+        if not self.profile_file.exists():
+            return {}
+        try:
+            with open(self.profile_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"加载资源记录失败，使用默认估算: {e}")
+            return {}
+
+    def save_profile(self):
+        """保存历史峰值内存记录"""
+        try:
+            self.profile_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.profile_file, 'w', encoding='utf-8') as f:
+                json.dump(self.profile, f, indent=2, ensure_ascii=False)
+        except Exception as e:
+            logger.warning(f"保存资源记录失败: {e}")
+
+    def default_cost(self, job_type: str) -> int:
+        """任务类型的默认内存估算（MB）"""
+        if job_type in self.default_costs:
+            return self.default_costs[job_type]
+        return self.default_costs.get(job_type.split('-')[0], self.default_costs["default"])
+
+    def estimate(self, job_type: str) -> int:
+        """任务的预估内存（MB）"""
+        learned = self.profile.get(job_type)
+        if learned:
+            return int(learned["estimate_mb"])
+        return self.default_cost(job_type)
+
+    def record_peak(self, job: BuildJob):
+        """根据本次峰值RSS更新该类任务的内存估算"""
+        # 运行时间短于采样间隔的任务没有有效数据
+        if job.samples == 0 or job.peak_rss_mb <= 0:
+            return
+
+        previous = self.profile.get(job.job_type, {})
+        recent_peaks = (previous.get("recent_peaks", []) + [job.peak_rss_mb])[-RECENT_PEAKS:]
+
+        # 首次采样与默认值平滑，之后与历史估算平滑，下限为最近峰值的最大值
+        target = int(job.peak_rss_mb * self.safety_factor)
+        smoothed = (self.estimate(job.job_type) + target) // 2
+        estimate = max(smoothed, int(max(recent_peaks) * self.safety_factor))
+        if job.requeued:
+            # 被提前终止的任务峰值偏低，只允许调高估算
+            estimate = max(estimate, self.estimate(job.job_type))
+
+        self.profile[job.job_type] = {
+            "estimate_mb": estimate,
+            "last_peak_mb": job.peak_rss_mb,
+            "recent_peaks": recent_peaks
+        }
+        self.save_profile()
+
+    def has_headroom(self, job: BuildJob) -> bool:
+        """判断当前是否有足够资源启动任务，调用方需持有锁"""
+        # 没有运行中的任务时总是放行，避免估算超过物理内存时永远等待
+        if not self.running:
+            return True
+        if any(running.paused for running in self.running):
+            return False
+        if self.max_jobs and len(self.running) >= self.max_jobs:
+            return False
+
+        load = read_load()
+        if load is not None and load > self.max_load_per_cpu:
+            return False
+
+        memory = read_memory()
+        if memory is None:
+            return True
+        # 运行中的任务还可能继续增长到其预估值
+        pending_growth = sum(max(0, self.estimate(r.job_type) - r.rss_mb) for r in self.running)
+        return memory[1] - pending_growth - self.reserve_mb >= self.estimate(job.job_type)
+
+    def acquire(self, job: BuildJob):
+        """等待直到任务可以启动，优先级高的任务先获得资源"""
+        with self.lock:
+            self.waiting.append(job)
+            while True:
+                if self.cancelled:
+                    self.waiting.remove(job)
+                    raise RuntimeError(f"资源调度已取消，任务 {job.name} 未启动")
+                head = max(self.waiting, key=lambda w: (w.priority, -w.seq))
+                if head is job and self.has_headroom(job):
+                    break
+                self.lock.wait(self.poll_interval)
+            self.waiting.remove(job)
+            job.rss_mb = 0
+            job.requeued = False
+            self.running.append(job)
+            self.ensure_monitor()
+
+    def release(self, job: BuildJob):
+        """任务结束，记录峰值并唤醒等待的任务"""
+        with self.lock:
+            if job in self.running:
+                self.running.remove(job)
+            self.record_peak(job)
+            self.lock.notify_all()
+
+    def cancel(self):
+        """取消等待中的任务并终止所有运行中的任务"""
+        with self.lock:
+            self.cancelled = True
+            for job in self.running:
+                logger.warning(f"终止任务 {job.name}")
+                self.signal_tree(job, 'kill')
+            self.lock.notify_all()
+
+    def ensure_monitor(self):
+        """启动监控线程，调用方需持有锁"""
+        if self.monitor_thread and self.monitor_thread.is_alive():
+            return
+        self.monitor_thread = threading.Thread(target=self.monitor, name='resource-governor', daemon=True)
+        self.monitor_thread.start()
+
+    def monitor(self):
+        """定期采样子进程RSS和系统内存，处理内存紧张"""
+        while True:
+            with self.lock:
+                if not self.running and not self.waiting:
+                    self.monitor_thread = None
+                    return
+
+                for job in self.running:
+                    if job.process and job.process.poll() is None:
+                        job.rss_mb = process_tree_rss(job.process.pid)
+                        job.peak_rss_mb = max(job.peak_rss_mb, job.rss_mb)
+                        job.samples += 1
+
+                memory = read_memory()
+                if memory is not None:
+                    self.handle_pressure(memory[1])
+                self.lock.notify_all()
+
+            time.sleep(self.poll_interval)
+
+    def handle_pressure(self, available_mb: int):
+        """内存紧张时处理最低优先级任务，恢复后继续已暂停任务，调用方需持有锁"""
+        # 进程已退出但尚未release的任务不能再被暂停或终止
+        active = [
+            job for job in self.running
+            if not job.paused and not job.requeued and job.process and job.process.poll() is None
+        ]
+        paused = [job for job in self.running if job.paused]
+
+        if available_mb < self.critical_available_mb and len(active) > 1:
+            candidates = [job for job in active if job.requeue_count < self.max_requeues]
+            if not candidates:
+                return
+            # 优先级最低的任务中选择最晚启动的，损失的进度最少
+            victim = min(candidates, key=lambda j: (j.priority, -j.started_at))
+            if self.critical_action == "pause":
+                if self.signal_tree(victim, 'suspend'):
+                    logger.warning(f"内存不足 ({available_mb}MB 可用)，暂停任务 {victim.name}")
+                    victim.paused = True
+            else:
+                if self.signal_tree(victim, 'kill'):
+                    logger.warning(f"内存不足 ({available_mb}MB 可用)，终止并重新排队任务 {victim.name}")
+                    victim.requeued = True
+            return
+
+        if not paused:
+            return
+        # 没有其他任务在运行时，内存不会再因本调度器释放，必须恢复暂停的任务，
+        # 否则它和所有等待中的任务都会一直阻塞
+        if not active or available_mb >= self.critical_available_mb + self.reserve_mb:
+            job = max(paused, key=lambda j: (j.priority, -j.started_at))
+            logger.info(f"继续任务 {job.name} ({available_mb}MB 可用)")
+            self.signal_tree(job, 'resume')
+            job.paused = False
+
+    def signal_tree(self, job: BuildJob, action: str) -> bool:
+        """暂停、恢复或终止任务的整个进程树，返回信号是否已发送"""
+        process = job.process
+        if not process or process.poll() is not None:
+            return False
+
+        if psutil:
+            try:
+                procs = [psutil.Process(pid) for pid in list_process_tree(process.pid)]
+            except psutil.Error:
+                procs = []
+            sent = False
+            for proc in procs:
+                try:
+                    if action == 'suspend':
+                        proc.suspend()
+                    elif action == 'resume':
+                        proc.resume()
+                    else:
+                        proc.kill()
+                    sent = True
+                except psutil.Error:
+                    continue
+            return sent
+
+        if sys.platform == 'win32':
+            if action != 'kill':
+                return False
+            try:
+                process.kill()
+            except OSError:
+                return False
+            return True
+
+        # POSIX下子进程以独立进程组启动，可直接对整个组发送信号
+        signals = {
+            'suspend': [signal.SIGSTOP],
+            'resume': [signal.SIGCONT],
+            'kill': [signal.SIGKILL, signal.SIGCONT]
+        }
+        sent = False
+        for sig in signals[action]:
+            try:
+                os.killpg(process.pid, sig)
+                sent = True
+            except OSError:
+                pass
+        return sent
+
+    def run(self, command: List[str], cwd: Path, job_type: str, priority: int = 0,
+            env: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+        """在资源允许时运行命令，被重新排队时自动重试"""
+        with self.lock:
+            self.seq += 1
+            job = BuildJob(command, job_type, priority, self.seq)
+
+        while True:
+            if self.waiting or self.running:
+                logger.info(f"任务 {job.name} 等待资源 (预估 {self.estimate(job_type)}MB)")
+            self.acquire(job)
+            try:
+                job.started_at = time.monotonic()
+                job.process = subprocess.Popen(
+                    command,
+                    cwd=cwd,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    start_new_session=sys.platform != 'win32'
+                )
+                try:
+                    stdout, stderr = job.process.communicate()
+                except BaseException:
+                    # 子进程在独立会话中，Ctrl-C不会传递给它们，需要主动终止
+                    self.signal_tree(job, 'kill')
+                    job.process.wait()
+                    raise
+            finally:
+                self.release(job)
+
+            # 只有确实被信号终止的任务才重新排队，已正常结束或自行失败的任务按实际结果返回
+            returncode = job.process.returncode
+            killed = returncode < 0 if sys.platform != 'win32' else returncode != 0
+            if job.requeued and killed:
+                job.requeue_count += 1
+                logger.info(f"任务 {job.name} 已重新排队 (第{job.requeue_count}次)")
+                continue
+
+            if job.process.returncode != 0:
+                raise subprocess.CalledProcessError(job.process.returncode, command, output=stdout, stderr=stderr)
+            return subprocess.CompletedProcess(command, job.process.returncode, stdout, stderr)